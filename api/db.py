@@ -1,7 +1,12 @@
 import os
+from contextvars import ContextVar
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import (
+    AsyncSession,
+    async_scoped_session,
+    async_sessionmaker,
+    create_async_engine,
+)
 
 
 def _db_url() -> str:
@@ -10,16 +15,28 @@ def _db_url() -> str:
     name = os.getenv("DB_NAME", "smartscale")
     user = os.getenv("DB_USER", "smartscale")
     password = os.getenv("DB_PASSWORD", "smartscale")
-    return f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{name}"
+    return f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{name}"
 
 
-engine = create_engine(_db_url(), pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+# No pre-ping: recycling bounds connection age without a SELECT 1 per checkout.
+# Async engines default to AsyncAdaptedQueuePool, sized the same way.
+engine = create_async_engine(
+    _db_url(),
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "60")),
+    pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+    pool_pre_ping=False,
+)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
+# One session per HTTP request: the middleware in main.py sets a fresh token
+# here and awaits ScopedSession.remove() once the response is produced. A
+# context variable (rather than the current task) is used because Starlette
+# runs the endpoint in a child task of the middleware.
+request_scope: ContextVar[object | None] = ContextVar("db_request_scope", default=None)
+ScopedSession = async_scoped_session(SessionLocal, scopefunc=request_scope.get)
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+
+async def get_db() -> AsyncSession:
+    return ScopedSession()
@@ -1,47 +1,151 @@
-import json
+import atexit
 import logging
 import os
+import queue
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
-RESERVED_ATTRS = {
-    "args",
-    "asctime",
-    "created",
-    "exc_info",
-    "exc_text",
-    "filename",
-    "funcName",
-    "levelname",
-    "levelno",
-    "lineno",
-    "module",
-    "msecs",
-    "message",
-    "msg",
-    "name",
-    "pathname",
-    "process",
-    "processName",
-    "relativeCreated",
-    "stack_info",
-    "thread",
-    "threadName",
-}
+import orjson
+
+RESERVED_ATTRS: frozenset[str] = frozenset(
+    {
+        "args",
+        "asctime",
+        "created",
+        "exc_info",
+        "exc_text",
+        "filename",
+        "funcName",
+        "levelname",
+        "levelno",
+        "lineno",
+        "module",
+        "msecs",
+        "message",
+        "msg",
+        "name",
+        "pathname",
+        "process",
+        "processName",
+        "relativeCreated",
+        "stack_info",
+        "thread",
+        "threadName",
+    }
+)
+LOG_FILE_BUFFER_SIZE = 1 << 16
+
+_LISTENERS: list[tuple[QueueHandler, QueueListener]] = []
+# BufferedFileHandlers whose locks are held while a fork is in progress.
+_FORK_HELD: list["BufferedFileHandler"] = []
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {
+        key: value
+        for key, value in record.__dict__.items()
+        if key not in RESERVED_ATTRS and not key.startswith("_")
+    }
+
+
+class ExtraFieldsFilter(logging.Filter):
+    """Collects ``extra=`` attributes into ``record._extra`` once per record,
+    so each handler's formatter does not rescan ``record.__dict__``."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "_extra"):
+            record._extra = _extra_fields(record)
+        return True
 
 
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
         payload = {
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            # Time of the logging call, not of formatting on the listener thread.
+            # orjson serializes datetimes natively; OPT_UTC_Z renders "+00:00" as "Z".
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc),
             "level": record.levelname,
             "logger": record.name,
             "message": record.getMessage(),
         }
-        for key, value in record.__dict__.items():
-            if key in RESERVED_ATTRS or key.startswith("_"):
-                continue
-            payload[key] = value
-        return json.dumps(payload, default=str)
+        extra = getattr(record, "_extra", None)
+        # Records from loggers without ExtraFieldsFilter fall back to a scan.
+        payload.update(extra if extra is not None else _extra_fields(record))
+        return orjson.dumps(payload, default=str, option=orjson.OPT_UTC_Z).decode()
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that only flushes when its buffer fills or on close()."""
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=LOG_FILE_BUFFER_SIZE,
+            encoding=self.encoding,
+            errors=self.errors,
+        )
+
+    def flush(self) -> None:
+        # StreamHandler.emit flushes after every record; closing the stream
+        # still writes out whatever is buffered.
+        pass
+
+
+def _start_listener(queue_handler: QueueHandler, handlers: list[logging.Handler]) -> None:
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _LISTENERS.append((queue_handler, listener))
+
+
+def shutdown_logging() -> None:
+    """Drain queued records and flush buffered files; safe to call twice."""
+    while _LISTENERS:
+        _, listener = _LISTENERS.pop()
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def _flush_before_fork() -> None:
+    # Locks stay held across fork() so the listener thread cannot refill the
+    # buffer (which the child would write again) or hold the stream's lock
+    # at the moment of the fork.
+    for _, listener in _LISTENERS:
+        for handler in listener.handlers:
+            if isinstance(handler, BufferedFileHandler):
+                handler.acquire()
+                _FORK_HELD.append(handler)
+                if handler.stream:
+                    handler.stream.flush()
+
+
+def _release_after_fork_in_parent() -> None:
+    while _FORK_HELD:
+        _FORK_HELD.pop().release()
+
+
+def _restart_listeners_after_fork() -> None:
+    while _FORK_HELD:
+        handler = _FORK_HELD.pop()
+        handler.createLock()
+        # Reopened on the next emit instead of sharing the parent's buffer.
+        handler.stream = None
+    # The listener thread does not survive fork (e.g. Celery prefork children).
+    inherited = list(_LISTENERS)
+    _LISTENERS.clear()
+    for queue_handler, listener in inherited:
+        _start_listener(queue_handler, list(listener.handlers))
+
+
+atexit.register(shutdown_logging)
+os.register_at_fork(
+    before=_flush_before_fork,
+    after_in_parent=_release_after_fork_in_parent,
+    after_in_child=_restart_listeners_after_fork,
+)
 
 
 def setup_logging(logger_name: str, log_path: str | None) -> logging.Logger:
@@ -50,16 +154,22 @@ def setup_logging(logger_name: str, log_path: str | None) -> logging.Logger:
         return logger
 
     logger.setLevel(logging.INFO)
+    logger.addFilter(ExtraFieldsFilter())
     formatter = JsonFormatter()
 
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    handlers: list[logging.Handler] = [stream_handler]
 
     if log_path:
         os.makedirs(os.path.dirname(log_path), exist_ok=True)
-        file_handler = logging.FileHandler(log_path)
+        file_handler = BufferedFileHandler(log_path)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    # Callers only enqueue; formatting and I/O happen on the listener thread.
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    logger.addHandler(queue_handler)
+    _start_listener(queue_handler, handlers)
 
     return logger
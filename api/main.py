@@ -1,28 +1,92 @@
-import hashlib
+import asyncio
 import os
+import shutil
 import time
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Any
 
-from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
+import pyarrow as pa
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy import text
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from celery_app import celery_app
-from db import get_db
+from celery_app import celery_app, enqueue_classify
+from db import ScopedSession, SessionLocal, get_db, request_scope
 from logging_utils import setup_logging
+from notifications import (
+    MODEL_RELOAD_CHANNEL,
+    job_done_waiter,
+    start_listener,
+    stop_listener,
+)
 
 IMAGE_STORAGE_PATH = os.getenv("IMAGE_STORAGE_PATH", "/data/images")
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "changeme")
 MODEL_ID = os.getenv("MODEL_ID", "Adriana213/vgg16-fruit-classifier")
 MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
 LOG_PATH = os.getenv("LOG_PATH")
+RESULT_STREAM_TIMEOUT = float(os.getenv("RESULT_STREAM_TIMEOUT", "20"))
+# Re-read the row this often in case a notification was lost (e.g. reconnect).
+RESULT_STREAM_RECHECK = 5.0
+FINAL_STATUSES = {"done", "error"}
+REGISTRY_CACHE_TTL = float(os.getenv("REGISTRY_CACHE_TTL", "30"))
+UPLOAD_COPY_CHUNK = 1 << 20
+HISTORY_ARROW_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("created_at", pa.timestamp("us", tz="UTC")),
+        ("status", pa.string()),
+        ("predicted_label", pa.string()),
+        ("confidence", pa.float64()),
+        ("top_k", pa.string()),
+        ("weight_kg", pa.float64()),
+        ("price_per_kg", pa.float64()),
+        ("total_price", pa.float64()),
+        ("confirmed_label", pa.string()),
+        ("error", pa.string()),
+    ]
+)
 
 logger = setup_logging("smartscale.api", LOG_PATH)
 
-app = FastAPI(title="SmartScale API", version="1.0.0")
+
+# Model registry as seen by /v1/predict. Dropped on reload here and, for the
+# other API processes, via the model_reload NOTIFY; the TTL is a backstop.
+# "gen" is bumped on every invalidation so a lookup that started before it
+# cannot write a stale value back.
+_REG_CACHE: dict[str, Any] = {"value": None, "exp": 0.0, "gen": 0}
+
+
+def _invalidate_registry_cache() -> None:
+    _REG_CACHE["exp"] = 0.0
+    _REG_CACHE["gen"] += 1
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_listener(on_model_reload=_invalidate_registry_cache, logger=logger)
+    try:
+        yield
+    finally:
+        await stop_listener()
+
+
+app = FastAPI(title="SmartScale API", version="1.0.0", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def db_session_scope(request: Request, call_next):
+    token = request_scope.set(object())
+    try:
+        return await call_next(request)
+    finally:
+        await ScopedSession.remove()
+        request_scope.reset(token)
 
 
 class PredictResponse(BaseModel):
@@ -64,21 +128,67 @@ def _ensure_storage_dir() -> None:
     os.makedirs(IMAGE_STORAGE_PATH, exist_ok=True)
 
 
-def _fetch_model_registry(db: Session) -> dict[str, str]:
-    row = db.execute(
-        text("SELECT model_id, model_revision FROM model_registry WHERE id = 1")
+def _store_upload(src, image_path: str) -> int:
+    """Copy the spooled upload to ``image_path`` and return its size in bytes.
+
+    Uploads Starlette has already spilled to a temp file are copied in-kernel
+    with sendfile; small in-memory ones go through copyfileobj in 1 MiB chunks.
+    """
+    with open(image_path, "wb") as f:
+        if getattr(src, "_rolled", False):
+            src_fd = src.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(f.fileno(), src_fd, offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+            size = offset
+        else:
+            shutil.copyfileobj(src, f, UPLOAD_COPY_CHUNK)
+            size = f.tell()
+    if not size:
+        os.remove(image_path)
+    return size
+
+
+def _dispatch_job(job_id: str, top_k: int, image_path: str) -> None:
+    enqueue_classify(job_id, top_k)
+    celery_app.send_task("worker_tasks.hash_image", args=[job_id, image_path])
+
+
+async def _fetch_model_registry(db: AsyncSession) -> dict[str, str]:
+    row = (
+        await db.execute(
+            text("SELECT model_id, model_revision FROM model_registry WHERE id = 1")
+        )
     ).mappings().first()
     if not row:
         return {"model_id": MODEL_ID, "model_revision": MODEL_REVISION}
     return {"model_id": row["model_id"], "model_revision": row["model_revision"]}
 
 
+def _cached_model_registry() -> dict[str, str] | None:
+    if _REG_CACHE["value"] is None or time.monotonic() >= _REG_CACHE["exp"]:
+        return None
+    return _REG_CACHE["value"]
+
+
+def _store_model_registry(value: dict[str, str], gen: int) -> None:
+    if _REG_CACHE["gen"] != gen:
+        # Invalidated while the lookup was in flight; the value may predate it.
+        return
+    _REG_CACHE["value"] = value
+    _REG_CACHE["exp"] = time.monotonic() + REGISTRY_CACHE_TTL
+
+
 @app.post("/v1/predict", response_model=PredictResponse)
 async def predict(
     image: UploadFile = File(...),
     weight_kg: float | None = Form(None),
     top_k: int = Form(3),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> PredictResponse:
     if top_k < 1:
         raise HTTPException(status_code=400, detail="top_k must be >= 1")
@@ -87,69 +197,98 @@ async def predict(
 
     _ensure_storage_dir()
     job_id = str(uuid.uuid4())
-    image_bytes = await image.read()
-    if not image_bytes:
-        raise HTTPException(status_code=400, detail="empty image payload")
-
-    image_sha = hashlib.sha256(image_bytes).hexdigest()
     ext = os.path.splitext(image.filename or "")[1] or ".jpg"
     image_path = os.path.join(IMAGE_STORAGE_PATH, f"{job_id}{ext}")
-    with open(image_path, "wb") as f:
-        f.write(image_bytes)
-
-    model_info = _fetch_model_registry(db)
-    db.execute(
-        text(
-            """
-            INSERT INTO inference_requests (
-                id, status, image_path, image_sha256, weight_kg, model_id, model_revision
-            ) VALUES (
-                :id, :status, :image_path, :image_sha256, :weight_kg, :model_id, :model_revision
+    # The worker needs the file before the job is queued, so the copy stays on
+    # the request path but runs off the event loop. Hashing is left to the worker.
+    if not await run_in_threadpool(_store_upload, image.file, image_path):
+        raise HTTPException(status_code=400, detail="empty image payload")
+
+    params = {
+        "id": job_id,
+        "status": "queued",
+        "image_path": image_path,
+        "weight_kg": weight_kg,
+    }
+    registry_gen = _REG_CACHE["gen"]
+    model_info = _cached_model_registry()
+    if model_info is not None:
+        await db.execute(
+            text(
+                """
+                INSERT INTO inference_requests (
+                    id, status, image_path, image_sha256, weight_kg, model_id, model_revision
+                ) VALUES (
+                    :id, :status, :image_path, NULL, :weight_kg, :model_id, :model_revision
+                )
+                """
+            ),
+            {**params, **model_info},
+        )
+    else:
+        # Cache miss: read the registry inside the INSERT, one round-trip instead of two.
+        row = (
+            await db.execute(
+                text(
+                    """
+                    WITH reg AS (
+                        SELECT model_id, model_revision FROM model_registry WHERE id = 1
+                    )
+                    INSERT INTO inference_requests (
+                        id, status, image_path, image_sha256, weight_kg, model_id, model_revision
+                    )
+                    SELECT
+                        CAST(:id AS uuid), :status, :image_path, NULL,
+                        CAST(:weight_kg AS float8),
+                        COALESCE((SELECT model_id FROM reg), :default_model_id),
+                        COALESCE((SELECT model_revision FROM reg), :default_model_revision)
+                    RETURNING model_id, model_revision
+                    """
+                ),
+                {
+                    **params,
+                    "default_model_id": MODEL_ID,
+                    "default_model_revision": MODEL_REVISION,
+                },
             )
-            """
-        ),
-        {
-            "id": job_id,
-            "status": "queued",
-            "image_path": image_path,
-            "image_sha256": image_sha,
-            "weight_kg": weight_kg,
-            "model_id": model_info["model_id"],
-            "model_revision": model_info["model_revision"],
-        },
-    )
-    db.commit()
+        ).mappings().first()
+        model_info = {"model_id": row["model_id"], "model_revision": row["model_revision"]}
+        _store_model_registry(model_info, registry_gen)
+    await db.commit()
 
-    celery_app.send_task("worker_tasks.classify", args=[job_id, top_k])
+    # Publishing blocks on the broker; keep it off the event loop too.
+    await run_in_threadpool(_dispatch_job, job_id, top_k, image_path)
 
     logger.info(
         "job_queued",
         extra={
             "job_id": job_id,
             "status": "queued",
-            "image_sha256": image_sha,
             "weight_kg": weight_kg,
+            "model_id": model_info["model_id"],
+            "model_revision": model_info["model_revision"],
         },
     )
 
     return PredictResponse(job_id=job_id, status="queued")
 
 
-@app.get("/v1/result/{job_id}", response_model=ResultResponse)
-def result(job_id: str, db: Session = Depends(get_db)) -> ResultResponse:
-    row = db.execute(
-        text(
-            """
-            SELECT status, predicted_label, confidence, top_k, price_per_kg,
-                   total_price, error, confirmed_label
-            FROM inference_requests WHERE id = :id
-            """
-        ),
-        {"id": job_id},
+async def _load_result(db: AsyncSession, job_id: str) -> ResultResponse | None:
+    row = (
+        await db.execute(
+            text(
+                """
+                SELECT status, predicted_label, confidence, top_k, price_per_kg,
+                       total_price, error, confirmed_label
+                FROM inference_requests WHERE id = :id
+                """
+            ),
+            {"id": job_id},
+        )
     ).mappings().first()
 
     if not row:
-        raise HTTPException(status_code=404, detail="job_id not found")
+        return None
 
     prediction = None
     if row["status"] == "done":
@@ -165,21 +304,59 @@ def result(job_id: str, db: Session = Depends(get_db)) -> ResultResponse:
     return ResultResponse(status=row["status"], prediction=prediction, error=row["error"])
 
 
-@app.get("/v1/history")
-def history(
-    limit: int = 50,
-    offset: int = 0,
+@app.get("/v1/result/{job_id}", response_model=ResultResponse)
+async def result(job_id: str, db: AsyncSession = Depends(get_db)) -> ResultResponse:
+    current = await _load_result(db, job_id)
+    if current is None:
+        raise HTTPException(status_code=404, detail="job_id not found")
+    return current
+
+
+@app.get("/v1/result/{job_id}/stream")
+async def result_stream(job_id: str, db: AsyncSession = Depends(get_db)):
+    """Server-sent event carrying the result once the worker NOTIFYs completion.
+
+    Emits a single ``data:`` event with the ResultResponse JSON, either when
+    the job reaches a final status or, with the current status, after
+    RESULT_STREAM_TIMEOUT seconds.
+    """
+    if await _load_result(db, job_id) is None:
+        raise HTTPException(status_code=404, detail="job_id not found")
+
+    async def events():
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RESULT_STREAM_TIMEOUT
+        while True:
+            with job_done_waiter(job_id) as done:
+                # The request-scoped session is gone once streaming starts.
+                async with SessionLocal() as stream_db:
+                    current = await _load_result(stream_db, job_id)
+                remaining = deadline - loop.time()
+                if current is None or current.status in FINAL_STATUSES or remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(done, timeout=min(remaining, RESULT_STREAM_RECHECK))
+                except asyncio.TimeoutError:
+                    pass
+        if current is not None:
+            yield f"data: {current.model_dump_json()}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def _history_filters(
     label: str | None = None,
-    date_from: str | None = None,
-    date_to: str | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
     min_confidence: float | None = None,
-    db: Session = Depends(get_db),
-):
-    if limit < 1 or limit > 500:
-        raise HTTPException(status_code=400, detail="limit must be 1..500")
-
+) -> tuple[str, dict[str, Any]]:
+    """WHERE clause and params shared by /v1/history and its aggregates."""
     clauses = ["1=1"]
-    params: dict[str, Any] = {"limit": limit, "offset": offset}
+    params: dict[str, Any] = {}
 
     if label:
         clauses.append("predicted_label = :label")
@@ -194,41 +371,208 @@ def history(
         clauses.append("confidence >= :min_confidence")
         params["min_confidence"] = min_confidence
 
+    return " AND ".join(clauses), params
+
+
+def _parse_history_cursor(cursor: str) -> tuple[datetime, str]:
+    created_at, _, job_id = cursor.rpartition(",")
+    try:
+        return datetime.fromisoformat(created_at), str(uuid.UUID(job_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid cursor") from None
+
+
+async def _history_page(
+    db: AsyncSession,
+    columns: str,
+    limit: int,
+    cursor: str | None,
+    filters: tuple[str, dict[str, Any]],
+) -> tuple[list, str | None]:
+    if limit < 1 or limit > 500:
+        raise HTTPException(status_code=400, detail="limit must be 1..500")
+
+    where, params = filters
+    params = {**params, "limit": limit}
+    if cursor:
+        where += " AND (created_at, id) < (:cursor_created_at, :cursor_id)"
+        params["cursor_created_at"], params["cursor_id"] = _parse_history_cursor(cursor)
+
+    query = text(
+        f"""
+        SELECT {columns}
+        FROM inference_requests
+        WHERE {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT :limit
+        """
+    )
+    rows = (await db.execute(query, params)).mappings().all()
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = f"{last['created_at'].isoformat()},{last['id']}"
+    return rows, next_cursor
+
+
+@app.get("/v1/history")
+async def history(
+    limit: int = 50,
+    cursor: str | None = None,
+    filters: tuple[str, dict[str, Any]] = Depends(_history_filters),
+    db: AsyncSession = Depends(get_db),
+):
+    """Newest first, keyset-paginated: pass the previous page's next_cursor."""
+    rows, next_cursor = await _history_page(
+        db,
+        """
+        id, created_at, status, predicted_label, confidence, top_k,
+        weight_kg, price_per_kg, total_price, confirmed_label, error
+        """,
+        limit,
+        cursor,
+        filters,
+    )
+    return {"items": rows, "limit": limit, "next_cursor": next_cursor}
+
+
+@app.get("/v1/history.arrow")
+async def history_arrow(
+    limit: int = 50,
+    cursor: str | None = None,
+    filters: tuple[str, dict[str, Any]] = Depends(_history_filters),
+    db: AsyncSession = Depends(get_db),
+) -> Response:
+    """Same page as /v1/history as an Arrow IPC stream.
+
+    top_k is rendered to JSON text by Postgres; the next cursor is returned
+    in the X-Next-Cursor header.
+    """
+    rows, next_cursor = await _history_page(
+        db,
+        """
+        CAST(id AS text) AS id, created_at, status, predicted_label, confidence,
+        CAST(top_k AS text) AS top_k, weight_kg, price_per_kg, total_price,
+        confirmed_label, error
+        """,
+        limit,
+        cursor,
+        filters,
+    )
+    table = pa.Table.from_pylist([dict(row) for row in rows], schema=HISTORY_ARROW_SCHEMA)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return Response(
+        content=sink.getvalue().to_pybytes(),
+        media_type="application/vnd.apache.arrow.stream",
+        headers=headers,
+    )
+
+
+@app.get("/v1/history/requests_per_day")
+async def history_requests_per_day(
+    filters: tuple[str, dict[str, Any]] = Depends(_history_filters),
+    db: AsyncSession = Depends(get_db),
+):
+    where, params = filters
     query = text(
         f"""
-        SELECT id, created_at, status, predicted_label, confidence, top_k,
-               weight_kg, price_per_kg, total_price, confirmed_label, error
+        SELECT date_trunc('day', created_at) AS day, count(*) AS count
         FROM inference_requests
-        WHERE {' AND '.join(clauses)}
-        ORDER BY created_at DESC
-        LIMIT :limit OFFSET :offset
+        WHERE {where}
+        GROUP BY day
+        ORDER BY day
         """
     )
-    rows = db.execute(query, params).mappings().all()
-    return {"items": rows, "limit": limit, "offset": offset}
+    rows = (await db.execute(query, params)).mappings().all()
+    return {"items": rows}
+
+
+@app.get("/v1/history/top_labels")
+async def history_top_labels(
+    limit: int = 10,
+    filters: tuple[str, dict[str, Any]] = Depends(_history_filters),
+    db: AsyncSession = Depends(get_db),
+):
+    if limit < 1 or limit > 100:
+        raise HTTPException(status_code=400, detail="limit must be 1..100")
+
+    where, params = filters
+    query = text(
+        f"""
+        SELECT predicted_label AS label, count(*) AS count
+        FROM inference_requests
+        WHERE {where} AND predicted_label IS NOT NULL
+        GROUP BY predicted_label
+        ORDER BY count DESC, label
+        LIMIT :limit
+        """
+    )
+    rows = (await db.execute(query, {**params, "limit": limit})).mappings().all()
+    return {"items": rows}
+
+
+@app.get("/v1/history/confidence_histogram")
+async def history_confidence_histogram(
+    bins: int = 10,
+    filters: tuple[str, dict[str, Any]] = Depends(_history_filters),
+    db: AsyncSession = Depends(get_db),
+):
+    if bins < 1 or bins > 100:
+        raise HTTPException(status_code=400, detail="bins must be 1..100")
+
+    where, params = filters
+    # width_bucket puts confidence == 1.0 in bucket bins + 1; fold it into the last bin.
+    query = text(
+        f"""
+        SELECT LEAST(width_bucket(confidence, 0, 1, :bins), :bins) AS bucket,
+               count(*) AS count
+        FROM inference_requests
+        WHERE {where} AND confidence IS NOT NULL
+        GROUP BY bucket
+        ORDER BY bucket
+        """
+    )
+    rows = (await db.execute(query, {**params, "bins": bins})).mappings().all()
+    return {
+        "items": [
+            {
+                "lower": (row["bucket"] - 1) / bins,
+                "upper": row["bucket"] / bins,
+                "count": row["count"],
+            }
+            for row in rows
+        ]
+    }
 
 
 @app.get("/v1/health")
-def health():
+async def health():
     return {"status": "ok", "time": time.time()}
 
 
 @app.post("/v1/confirm/{job_id}")
-def confirm_label(job_id: str, payload: ConfirmRequest, db: Session = Depends(get_db)):
-    result = db.execute(
-        text(
-            """
-            UPDATE inference_requests
-            SET confirmed_label = :confirmed_label
-            WHERE id = :id
-            RETURNING id
-            """
-        ),
-        {"id": job_id, "confirmed_label": payload.confirmed_label},
+async def confirm_label(
+    job_id: str, payload: ConfirmRequest, db: AsyncSession = Depends(get_db)
+):
+    result = (
+        await db.execute(
+            text(
+                """
+                UPDATE inference_requests
+                SET confirmed_label = :confirmed_label
+                WHERE id = :id
+                RETURNING id
+                """
+            ),
+            {"id": job_id, "confirmed_label": payload.confirmed_label},
+        )
     ).mappings().first()
     if not result:
         raise HTTPException(status_code=404, detail="job_id not found")
-    db.commit()
+    await db.commit()
 
     logger.info(
         "label_confirmed",
@@ -238,32 +582,36 @@ def confirm_label(job_id: str, payload: ConfirmRequest, db: Session = Depends(ge
 
 
 @app.post("/v1/admin/reload-model", response_model=ModelInfo)
-def reload_model(
+async def reload_model(
     payload: ReloadRequest,
     x_admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> ModelInfo:
     if x_admin_token != ADMIN_TOKEN:
         raise HTTPException(status_code=403, detail="invalid admin token")
 
-    current = _fetch_model_registry(db)
+    current = await _fetch_model_registry(db)
     model_id = payload.model_id or current["model_id"]
     model_revision = payload.model_revision or current["model_revision"]
 
-    row = db.execute(
-        text(
-            """
-            UPDATE model_registry
-            SET model_id = :model_id,
-                model_revision = :model_revision,
-                updated_at = now()
-            WHERE id = 1
-            RETURNING model_id, model_revision, updated_at
-            """
-        ),
-        {"model_id": model_id, "model_revision": model_revision},
+    row = (
+        await db.execute(
+            text(
+                """
+                UPDATE model_registry
+                SET model_id = :model_id,
+                    model_revision = :model_revision,
+                    updated_at = now()
+                WHERE id = 1
+                RETURNING model_id, model_revision, updated_at
+                """
+            ),
+            {"model_id": model_id, "model_revision": model_revision},
+        )
     ).mappings().first()
-    db.commit()
+    await db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": MODEL_RELOAD_CHANNEL})
+    await db.commit()
+    _invalidate_registry_cache()
 
     logger.info(
         "model_reload_requested",
@@ -277,15 +625,17 @@ def reload_model(
 
 
 @app.get("/v1/admin/model", response_model=ModelInfo)
-def model_info(
+async def model_info(
     x_admin_token: str | None = Header(default=None, alias="X-Admin-Token"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> ModelInfo:
     if x_admin_token != ADMIN_TOKEN:
         raise HTTPException(status_code=403, detail="invalid admin token")
 
-    row = db.execute(
-        text("SELECT model_id, model_revision, updated_at FROM model_registry WHERE id = 1")
+    row = (
+        await db.execute(
+            text("SELECT model_id, model_revision, updated_at FROM model_registry WHERE id = 1")
+        )
     ).mappings().first()
     if not row:
         raise HTTPException(status_code=404, detail="model registry not initialized")
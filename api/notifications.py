@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager, suppress
+
+from db import engine
+
+JOB_DONE_CHANNEL = "job_done"
+MODEL_RELOAD_CHANNEL = "model_reload"
+
+# Delay before reconnecting the listener, doubling up to the max.
+LISTENER_RETRY_MIN = 1.0
+LISTENER_RETRY_MAX = 30.0
+# How often an idle listener connection is pinged to notice a dead socket.
+LISTENER_PING_INTERVAL = 30.0
+
+_waiters: dict[str, set[asyncio.Future]] = {}
+_listener_task: asyncio.Task | None = None
+
+
+def _on_job_done(connection, pid, channel, payload: str) -> None:
+    for waiter in _waiters.pop(payload, ()):
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def _listen(on_model_reload: Callable[[], None], logger: logging.Logger) -> None:
+    retry = LISTENER_RETRY_MIN
+    while True:
+        try:
+            async with engine.connect() as conn:
+                try:
+                    raw = (await conn.get_raw_connection()).driver_connection
+                    lost = asyncio.Event()
+                    raw.add_termination_listener(lambda connection: lost.set())
+                    await raw.add_listener(JOB_DONE_CHANNEL, _on_job_done)
+                    await raw.add_listener(
+                        MODEL_RELOAD_CHANNEL,
+                        lambda connection, pid, channel, payload: on_model_reload(),
+                    )
+                    # Reloads announced while disconnected were missed.
+                    on_model_reload()
+                    logger.info("listener_connected")
+                    retry = LISTENER_RETRY_MIN
+                    while not lost.is_set():
+                        try:
+                            await asyncio.wait_for(lost.wait(), LISTENER_PING_INTERVAL)
+                        except asyncio.TimeoutError:
+                            await asyncio.wait_for(
+                                raw.execute("SELECT 1"), LISTENER_PING_INTERVAL
+                            )
+                    raise ConnectionError("listener connection terminated")
+                finally:
+                    # Never hand a LISTENing connection back to the request pool.
+                    await conn.invalidate()
+        except Exception as exc:
+            logger.warning("listener_disconnected", extra={"error": str(exc)})
+        # Streams fall back to RESULT_STREAM_RECHECK polling until reconnected.
+        await asyncio.sleep(retry)
+        retry = min(retry * 2, LISTENER_RETRY_MAX)
+
+
+def start_listener(on_model_reload: Callable[[], None], logger: logging.Logger) -> None:
+    """LISTEN for finished jobs and model reloads on one connection per API
+    process, reconnecting in the background whenever it is lost."""
+    global _listener_task
+    _listener_task = asyncio.get_running_loop().create_task(
+        _listen(on_model_reload, logger)
+    )
+
+
+async def stop_listener() -> None:
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _listener_task
+        _listener_task = None
+
+
+@contextmanager
+def job_done_waiter(job_id: str) -> Iterator[asyncio.Future]:
+    """Future resolved by the worker's NOTIFY for ``job_id``.
+
+    Register before reading the job's status so a notification sent in
+    between is not missed.
+    """
+    waiter = asyncio.get_running_loop().create_future()
+    _waiters.setdefault(job_id, set()).add(waiter)
+    try:
+        yield waiter
+    finally:
+        waiters = _waiters.get(job_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del _waiters[job_id]
@@ -5,7 +5,7 @@ CREATE TABLE IF NOT EXISTS inference_requests (
   created_at timestamptz NOT NULL DEFAULT now(),
   status text NOT NULL,
   image_path text NOT NULL,
-  image_sha256 text NOT NULL,
+  image_sha256 text NULL,
   weight_kg float8 NULL,
   predicted_label text NULL,
   confidence float8 NULL,
@@ -16,9 +16,21 @@ CREATE TABLE IF NOT EXISTS inference_requests (
   model_revision text NOT NULL,
   latency_ms int NULL,
   error text NULL,
-  confirmed_label text NULL
+  confirmed_label text NULL,
+  -- Hashing runs after the upload is queued; a finished job must have it.
+  CONSTRAINT image_sha256_when_done CHECK (status <> 'done' OR image_sha256 IS NOT NULL)
 );
 
+-- /v1/history: newest first with keyset pagination, optionally by label/confidence.
+CREATE INDEX IF NOT EXISTS ix_ir_created_at
+  ON inference_requests (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_ir_label_created
+  ON inference_requests (predicted_label, created_at DESC, id DESC)
+  WHERE predicted_label IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_ir_confidence
+  ON inference_requests (confidence)
+  WHERE confidence IS NOT NULL;
+
 CREATE TABLE IF NOT EXISTS product_prices (
   label text PRIMARY KEY,
   price_per_kg float8 NOT NULL
@@ -0,0 +1,6 @@
+-- Apply to databases created before image hashing moved to the worker.
+ALTER TABLE inference_requests ALTER COLUMN image_sha256 DROP NOT NULL;
+
+ALTER TABLE inference_requests
+  ADD CONSTRAINT image_sha256_when_done
+  CHECK (status <> 'done' OR image_sha256 IS NOT NULL);
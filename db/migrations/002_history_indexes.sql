@@ -0,0 +1,12 @@
+-- Apply to databases created before the /v1/history indexes were added.
+-- CONCURRENTLY cannot run inside a transaction block; run with psql's default autocommit.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ir_created_at
+  ON inference_requests (created_at DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ir_label_created
+  ON inference_requests (predicted_label, created_at DESC, id DESC)
+  WHERE predicted_label IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ir_confidence
+  ON inference_requests (confidence)
+  WHERE confidence IS NOT NULL;
@@ -1,9 +1,9 @@
 import json
 import os
-import time
 from typing import Any
 
 import pandas as pd
+import pyarrow as pa
 import requests
 import streamlit as st
 
@@ -33,6 +33,18 @@ def _get_result(job_id: str) -> dict[str, Any]:
     return response.json()
 
 
+def _wait_for_result(job_id: str) -> dict[str, Any]:
+    """Block on the API's result stream instead of polling /result."""
+    with requests.get(
+        f"{API_BASE_URL}/result/{job_id}/stream", stream=True, timeout=(5, 30)
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data:"):
+                return json.loads(line[len("data:"):])
+    return {"status": "queued"}
+
+
 def _post_confirm(job_id: str, confirmed_label: str) -> None:
     response = requests.post(
         f"{API_BASE_URL}/confirm/{job_id}",
@@ -42,10 +54,17 @@ def _post_confirm(job_id: str, confirmed_label: str) -> None:
     response.raise_for_status()
 
 
-def _fetch_history(params: dict[str, Any]) -> dict[str, Any]:
-    response = requests.get(f"{API_BASE_URL}/history", params=params, timeout=15)
+def _fetch_history(params: dict[str, Any]) -> pd.DataFrame:
+    response = requests.get(f"{API_BASE_URL}/history.arrow", params=params, timeout=15)
     response.raise_for_status()
-    return response.json()
+    table = pa.ipc.open_stream(response.content).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _fetch_history_aggregate(name: str, params: dict[str, Any]) -> list[dict[str, Any]]:
+    response = requests.get(f"{API_BASE_URL}/history/{name}", params=params, timeout=15)
+    response.raise_for_status()
+    return response.json()["items"]
 
 
 st.set_page_config(page_title="SmartScale", layout="wide")
@@ -78,16 +97,10 @@ with weigh_tab:
         st.info(f"Job submitted: {job_id}")
 
         with st.spinner("Running inference..."):
-            result = {"status": "queued"}
-            for _ in range(40):
-                try:
-                    result = _get_result(job_id)
-                except requests.RequestException:
-                    time.sleep(0.5)
-                    continue
-                if result["status"] in {"done", "error"}:
-                    break
-                time.sleep(0.5)
+            try:
+                result = _wait_for_result(job_id)
+            except requests.RequestException:
+                result = {"status": "queued"}
 
         st.session_state["last_result"] = result
 
@@ -150,7 +163,7 @@ with analytics_tab:
         limit = st.number_input("Rows", min_value=10, max_value=200, value=50, step=10)
 
     date_range = st.date_input("Date range", value=())
-    params: dict[str, Any] = {"limit": int(limit), "offset": 0}
+    params: dict[str, Any] = {"limit": int(limit)}
     if label_filter:
         params["label"] = label_filter
     if min_conf > 0:
@@ -160,42 +173,40 @@ with analytics_tab:
         params["date_to"] = date_range[1].isoformat()
 
     try:
-        data = _fetch_history(params)
-        items = data.get("items", [])
+        df = _fetch_history(params)
     except requests.RequestException as exc:
         st.error(f"Failed to fetch history: {exc}")
-        items = []
-
-    if items:
-        df = pd.DataFrame(items)
-        if "top_k" in df.columns:
-            df["top_k"] = df["top_k"].apply(
-                lambda value: json.dumps(value, ensure_ascii=True)
-                if isinstance(value, (list, dict))
-                else value
-            )
+        df = pd.DataFrame()
+
+    if not df.empty:
+        # top_k arrives as JSON text, ready to display.
         st.dataframe(df, use_container_width=True)
 
-        if "created_at" in df.columns:
-            df["created_at"] = pd.to_datetime(df["created_at"])
-            requests_over_time = df.set_index("created_at").resample("D").size()
-            if not requests_over_time.empty:
-                st.line_chart(requests_over_time, height=200)
-
-        if "predicted_label" in df.columns:
-            top_labels = df["predicted_label"].value_counts().head(10)
-            if not top_labels.empty:
-                st.bar_chart(top_labels, height=200)
-
-        if "confidence" in df.columns:
-            conf_series = df["confidence"].dropna()
-            if not conf_series.empty:
-                hist = pd.cut(conf_series, bins=10).value_counts().sort_index()
-                if not hist.empty:
-                    hist_df = hist.reset_index()
-                    hist_df.columns = ["bin", "count"]
-                    hist_df["bin"] = hist_df["bin"].astype(str)
-                    st.bar_chart(hist_df, x="bin", y="count", height=200)
+        # Aggregates are computed by Postgres over the same filters.
+        filter_params = {k: v for k, v in params.items() if k != "limit"}
+        try:
+            per_day = _fetch_history_aggregate("requests_per_day", filter_params)
+            top_labels = _fetch_history_aggregate("top_labels", {**filter_params, "limit": 10})
+            histogram = _fetch_history_aggregate("confidence_histogram", filter_params)
+        except requests.RequestException as exc:
+            st.error(f"Failed to fetch history aggregates: {exc}")
+            per_day, top_labels, histogram = [], [], []
+
+        if per_day:
+            per_day_df = pd.DataFrame(per_day)
+            per_day_df["day"] = pd.to_datetime(per_day_df["day"])
+            st.line_chart(per_day_df, x="day", y="count", height=200)
+
+        if top_labels:
+            st.bar_chart(pd.DataFrame(top_labels), x="label", y="count", height=200)
+
+        if histogram:
+            hist_df = pd.DataFrame(histogram)
+            hist_df["bin"] = [
+                f"[{lower:.1f}, {upper:.1f})"
+                for lower, upper in zip(hist_df["lower"], hist_df["upper"])
+            ]
+            st.bar_chart(hist_df, x="bin", y="count", height=200)
     else:
         st.info("No history yet.")
 
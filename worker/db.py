@@ -1,5 +1,6 @@
 import os
 
+import orjson
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -13,7 +14,13 @@ def _db_url() -> str:
     return f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{name}"
 
 
-engine = create_engine(_db_url(), pool_pre_ping=True)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+engine = create_engine(
+    _db_url(),
+    pool_recycle=DB_POOL_RECYCLE,
+    json_serializer=lambda value: orjson.dumps(value).decode(),
+)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 
 
@@ -1,18 +1,47 @@
 import json
 import os
+from contextlib import suppress
 from datetime import datetime, timezone
 
+# oneDNN reads these when TensorFlow is imported; BF16 math mode only takes
+# effect on CPUs with native bf16 support (AVX512-BF16 / AMX).
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+os.environ.setdefault("ONEDNN_DEFAULT_FPMATH_MODE", "BF16")
+
+import numpy as np
 import tensorflow as tf
 from huggingface_hub import snapshot_download
 from sqlalchemy import text
 
+from preprocessing import TARGET_SIZE, load_image_into, subtract_mean
+
 MODEL_ID = os.getenv("MODEL_ID", "Adriana213/vgg16-fruit-classifier")
 MODEL_REVISION = os.getenv("MODEL_REVISION", "main")
+# "keras" (FP32 TF) or "onnx-int8" (statically quantized ONNX Runtime session).
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "keras")
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "/models/onnx")
+CALIBRATION_DIR = os.getenv("IMAGE_STORAGE_PATH", "/data/images")
+CALIBRATION_SAMPLES = int(os.getenv("CALIBRATION_SAMPLES", "32"))
+CALIBRATION_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# Defaults would size the pools to every host CPU in each worker process.
+INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", "4"))
+INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", "1"))
+# XLA:CPU convolutions bypass oneDNN (and so its BF16 mode); opt-in only.
+JIT_COMPILE = os.getenv("TF_JIT_COMPILE", "0") == "1"
+
+tf.config.threading.set_intra_op_parallelism_threads(INTRA_OP_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(INTER_OP_THREADS)
+
+# Filled on first model load; see _gpu_devices.
+_GPU_DEVICES = None
 
 MODEL_STATE = {
     "model_id": None,
     "model_revision": None,
+    "backend": None,
     "model": None,
+    "session": None,
+    "infer": None,
     "labels": None,
     "model_path": None,
     "loaded_at": None,
@@ -28,6 +57,22 @@ def _fetch_registry(db):
     return {"model_id": row["model_id"], "model_revision": row["model_revision"]}
 
 
+def _gpu_devices():
+    """Physical GPUs, listed on first use rather than at import.
+
+    Listing devices initialises CUDA. The Celery parent imports this module
+    before forking the pool, and forked children cannot re-initialise CUDA,
+    so this must first run in the child that does inference.
+    """
+    global _GPU_DEVICES
+    if _GPU_DEVICES is None:
+        _GPU_DEVICES = tf.config.list_physical_devices("GPU")
+        for gpu in _GPU_DEVICES:
+            # Share the card with other worker processes instead of reserving all memory.
+            tf.config.experimental.set_memory_growth(gpu, True)
+    return _GPU_DEVICES
+
+
 def _load_labels(labels_path: str, logger=None) -> list[str] | None:
     if not os.path.exists(labels_path):
         if logger:
@@ -39,28 +84,156 @@ def _load_labels(labels_path: str, logger=None) -> list[str] | None:
     return [label for _, label in items]
 
 
+class _CalibrationReader:
+    """Feeds preprocessed uploads to onnxruntime's static quantizer one at a time."""
+
+    def __init__(self, input_name: str, paths: list[str]):
+        self._input_name = input_name
+        self._paths = iter(paths)
+
+    def get_next(self):
+        for path in self._paths:
+            batch = np.empty((1, *TARGET_SIZE, 3), dtype=np.float32)
+            try:
+                load_image_into(path, batch[0])
+            except OSError:
+                continue
+            subtract_mean(batch)
+            return {self._input_name: batch}
+        return None
+
+
+def _calibration_paths() -> list[str]:
+    if not os.path.isdir(CALIBRATION_DIR):
+        return []
+    names = sorted(
+        name for name in os.listdir(CALIBRATION_DIR)
+        if name.lower().endswith(CALIBRATION_EXTENSIONS)
+    )
+    return [os.path.join(CALIBRATION_DIR, name) for name in names[:CALIBRATION_SAMPLES]]
+
+
+def _load_onnx_int8(model, model_id: str, model_path: str, logger=None):
+    import onnxruntime as ort
+    import tf2onnx
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    # Snapshot directories are named after the resolved commit, so "main" is
+    # re-quantized whenever the upstream revision moves.
+    cache_dir = os.path.join(
+        ONNX_CACHE_DIR, model_id.replace("/", "--"), os.path.basename(model_path)
+    )
+    quantized_path = os.path.join(cache_dir, "model.int8.onnx")
+    if not os.path.exists(quantized_path):
+        paths = _calibration_paths()
+        if not paths:
+            if logger:
+                logger.warning(
+                    "onnx_calibration_missing", extra={"calibration_dir": CALIBRATION_DIR}
+                )
+            return None
+        # Per-process temp files: prefork children may all convert at once.
+        fp32_path = os.path.join(cache_dir, f"model.{os.getpid()}.onnx")
+        tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            spec = (tf.TensorSpec((None, *TARGET_SIZE, 3), tf.float32, name="input"),)
+            tf2onnx.convert.from_keras(model, input_signature=spec, output_path=fp32_path)
+            quantize_static(
+                fp32_path,
+                tmp_path,
+                _CalibrationReader("input", paths),
+                quant_format=QuantFormat.QDQ,
+                activation_type=QuantType.QUInt8,
+                weight_type=QuantType.QInt8,
+            )
+            os.replace(tmp_path, quantized_path)
+        except Exception as exc:
+            if logger:
+                logger.error("onnx_int8_failed", extra={"stage": "quantize", "error": str(exc)})
+            return None
+        finally:
+            for path in (fp32_path, tmp_path):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+        if logger:
+            logger.info(
+                "onnx_model_quantized",
+                extra={"onnx_path": quantized_path, "calibration_samples": len(paths)},
+            )
+    providers = [
+        provider
+        for provider in ("CUDAExecutionProvider", "CPUExecutionProvider")
+        if provider in ort.get_available_providers()
+    ]
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = INTRA_OP_THREADS
+    options.inter_op_num_threads = INTER_OP_THREADS
+    try:
+        return ort.InferenceSession(quantized_path, sess_options=options, providers=providers)
+    except Exception as exc:
+        if logger:
+            logger.error("onnx_int8_failed", extra={"stage": "session", "error": str(exc)})
+        return None
+
+
 def _load_model(model_id: str, model_revision: str, logger=None):
     model_path = snapshot_download(repo_id=model_id, revision=model_revision)
     labels = _load_labels(os.path.join(model_path, "class_labels.json"), logger=logger)
-    model = tf.keras.models.load_model(model_path, compile=False)
-    return model, labels, model_path
+    with tf.device("/GPU:0" if _gpu_devices() else "/CPU:0"):
+        model = tf.keras.models.load_model(model_path, compile=False)
+    session = None
+    if INFERENCE_BACKEND == "onnx-int8":
+        session = _load_onnx_int8(model, model_id, model_path, logger)
+        if session is not None:
+            # The quantized session replaces the FP32 graph; free it.
+            model = None
+    return model, session, labels, model_path
+
+
+def _compile_model(model):
+    """XLA-compiled forward pass; None falls back to Keras predict.
+
+    Always used on the GPU, and on the CPU only with TF_JIT_COMPILE=1. XLA
+    compiles once per distinct batch size (at most BATCH_MAX shapes).
+    """
+    if model is None or not (_gpu_devices() or JIT_COMPILE):
+        return None
+
+    @tf.function(jit_compile=True, reduce_retracing=True)
+    def infer(x):
+        return model(x, training=False)
+
+    return infer
+
+
+def predict(state, x: np.ndarray) -> np.ndarray:
+    session = state["session"]
+    if session is not None:
+        return session.run(None, {session.get_inputs()[0].name: x})[0]
+    if state["infer"] is not None:
+        return state["infer"](tf.convert_to_tensor(x)).numpy()
+    return state["model"].predict(x, verbose=0, batch_size=len(x))
 
 
 def ensure_model(db, logger):
     target = _fetch_registry(db)
     if (
-        MODEL_STATE["model"] is None
+        MODEL_STATE["loaded_at"] is None
         or MODEL_STATE["model_id"] != target["model_id"]
         or MODEL_STATE["model_revision"] != target["model_revision"]
     ):
-        model, labels, model_path = _load_model(
+        model, session, labels, model_path = _load_model(
             target["model_id"], target["model_revision"], logger
         )
         MODEL_STATE.update(
             {
                 "model_id": target["model_id"],
                 "model_revision": target["model_revision"],
+                "backend": "onnx-int8" if session is not None else "keras",
                 "model": model,
+                "session": session,
+                "infer": _compile_model(model),
                 "labels": labels,
                 "model_path": model_path,
                 "loaded_at": datetime.now(timezone.utc).isoformat(),
@@ -71,6 +244,8 @@ def ensure_model(db, logger):
             extra={
                 "model_id": target["model_id"],
                 "model_revision": target["model_revision"],
+                "backend": MODEL_STATE["backend"],
+                "gpu": bool(_gpu_devices()),
                 "loaded_at": MODEL_STATE["loaded_at"],
             },
         )
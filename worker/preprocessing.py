@@ -0,0 +1,18 @@
+import numpy as np
+from PIL import Image
+
+TARGET_SIZE = (100, 100)
+# VGG16 "caffe" preprocessing: BGR channel order, ImageNet mean subtracted, no scaling.
+VGG16_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+
+def load_image_into(path: str, out: np.ndarray) -> None:
+    """Decode, resize and write an image into ``out`` (H, W, 3) in BGR order."""
+    with Image.open(path) as im:
+        # NEAREST matches keras load_img's default interpolation used so far.
+        im = im.convert("RGB").resize(TARGET_SIZE, Image.NEAREST)
+        out[...] = np.asarray(im)[:, :, ::-1]
+
+
+def subtract_mean(batch: np.ndarray) -> None:
+    batch -= VGG16_MEAN_BGR
@@ -1,85 +1,242 @@
-import json
+import hashlib
 import os
 import time
+from typing import Any
 
 import numpy as np
-from sqlalchemy import text
-from tensorflow.keras.applications.vgg16 import preprocess_input
-from tensorflow.keras.preprocessing import image as keras_image
+from celery.signals import worker_process_init, worker_process_shutdown
+from kombu import Queue
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects.postgresql import JSONB
 
-from db import get_db_session
-from logging_utils import setup_logging
-from model_loader import ensure_model
-from worker_app import celery_app
+from logging_utils import setup_logging, shutdown_logging
+from model_loader import ensure_model, predict
+from preprocessing import TARGET_SIZE, load_image_into, subtract_mean
+from worker_app import celery_app, get_worker_db, run_in_worker_db
 
 DEFAULT_PRICE_PER_KG = float(os.getenv("DEFAULT_PRICE_PER_KG", "2.99"))
 CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD", "0.55"))
 LOG_PATH = os.getenv("LOG_PATH")
-TARGET_SIZE = (100, 100)
+PENDING_QUEUE = os.getenv("CLASSIFY_PENDING_QUEUE", "classify_pending")
+BATCH_MAX = int(os.getenv("BATCH_MAX", "16"))
+BATCH_TIMEOUT_MS = int(os.getenv("BATCH_TIMEOUT_MS", "20"))
+BATCH_FIRST_WAIT_MS = int(os.getenv("BATCH_FIRST_WAIT_MS", "1000"))
+JOB_DONE_CHANNEL = "job_done"
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "60"))
 
 logger = setup_logging("smartscale.worker", LOG_PATH)
 
 
-@celery_app.task(name="worker_tasks.classify")
-def classify(job_id: str, top_k: int = 3) -> None:
-    start_time = time.time()
-    db = get_db_session()
+@worker_process_shutdown.connect
+def _flush_logs(**_):
+    # Pool children exit without running atexit hooks.
+    shutdown_logging()
+
+
+# Reused across batches so preprocessing does not allocate per image.
+_BATCH_BUF = np.empty((BATCH_MAX, *TARGET_SIZE, 3), dtype=np.float32)
+
+# label -> (price_per_kg or None when the label has no price row, expires_at).
+_PRICE_CACHE: dict[str, tuple[float | None, float]] = {}
+
+_pending_queue = Queue(PENDING_QUEUE, routing_key=PENDING_QUEUE)
+# Sleep between empty basic_get polls while waiting for the next job.
+_PENDING_POLL_INTERVAL = 0.002
+
+
+def _drain_pending() -> tuple[list[dict[str, Any]], int]:
+    """Pull up to BATCH_MAX queued jobs; returns them and how many remain queued.
+
+    Returns at once when the queue is empty: each job is published before
+    its trigger, so an empty queue means another drain already took it.
+    Otherwise waits up to BATCH_FIRST_WAIT_MS for the first job, then keeps
+    coalescing for BATCH_TIMEOUT_MS after it arrived. basic_get takes one
+    message per round-trip, so nothing sits prefetched on the channel when it
+    closes.
+    """
+    jobs: list[dict[str, Any]] = []
+    with celery_app.connection_or_acquire() as conn:
+        channel = conn.channel()
+        try:
+            pending = _pending_queue(channel)
+            _, queued, _ = pending.queue_declare()
+            if not queued:
+                return jobs, 0
+            deadline = time.monotonic() + BATCH_FIRST_WAIT_MS / 1000
+            while len(jobs) < BATCH_MAX:
+                message = pending.get(no_ack=False, accept=["json"])
+                if message is None:
+                    if time.monotonic() >= deadline:
+                        break
+                    time.sleep(_PENDING_POLL_INTERVAL)
+                    continue
+                message.ack()
+                jobs.append(message.payload)
+                if len(jobs) == 1:
+                    deadline = time.monotonic() + BATCH_TIMEOUT_MS / 1000
+            _, backlog, _ = pending.queue_declare(passive=True)
+        finally:
+            channel.close()
+    return jobs, backlog
+
+
+def _fetch_prices(db, labels: set[str]) -> dict[str, float]:
+    now = time.monotonic()
+    missing = sorted(
+        label for label in labels if label not in _PRICE_CACHE or _PRICE_CACHE[label][1] <= now
+    )
+    if missing:
+        rows = db.execute(
+            text(
+                "SELECT label, price_per_kg FROM product_prices WHERE label IN :labels"
+            ).bindparams(bindparam("labels", expanding=True)),
+            {"labels": missing},
+        ).mappings().all()
+        found = {row["label"]: row["price_per_kg"] for row in rows}
+        expires_at = now + PRICE_CACHE_TTL
+        for label in missing:
+            _PRICE_CACHE[label] = (found.get(label), expires_at)
+    prices = {}
+    for label in labels:
+        price = _PRICE_CACHE[label][0]
+        if price is not None:
+            prices[label] = price
+    return prices
+
+
+@worker_process_init.connect
+def _preload_prices(**_):
     try:
-        row = db.execute(
-            text("SELECT image_path, weight_kg FROM inference_requests WHERE id = :id"),
-            {"id": job_id},
-        ).mappings().first()
-        if not row:
-            logger.error("job_missing", extra={"job_id": job_id})
-            return
+        db = get_worker_db()
+        with db.begin():
+            rows = db.execute(
+                text("SELECT label, price_per_kg FROM product_prices")
+            ).mappings().all()
+    except Exception as exc:
+        # Prices are fetched lazily on a miss; a failed preload is not fatal.
+        logger.warning("price_preload_failed", extra={"error": str(exc)})
+        return
+    expires_at = time.monotonic() + PRICE_CACHE_TTL
+    for row in rows:
+        _PRICE_CACHE[row["label"]] = (row["price_per_kg"], expires_at)
 
-        db.execute(
-            text("UPDATE inference_requests SET status = 'running' WHERE id = :id"),
-            {"id": job_id},
-        )
-        db.commit()
 
-        state = ensure_model(db, logger)
-        model = state["model"]
-        labels = state["labels"] or []
+def _file_sha256(path: str) -> str:
+    # Streams the file in fixed-size chunks instead of reading it into memory.
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _mark_errors(db, errors: dict[str, str]) -> None:
+    if not errors:
+        return
+    db.execute(
+        text("UPDATE inference_requests SET status = 'error', error = :error WHERE id = :id"),
+        [{"id": job_id, "error": error} for job_id, error in errors.items()],
+    )
+
+
+def _top_k(probs: np.ndarray, k: int) -> tuple[list[list[int]], list[list[float]]]:
+    """Per-row top-k class indices and confidences, highest first.
+
+    argpartition selects the k candidates in O(N); only those k get sorted.
+    """
+    top = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    top_probs = np.take_along_axis(probs, top, axis=1)
+    order = np.argsort(-top_probs, axis=1)
+    return (
+        np.take_along_axis(top, order, axis=1).tolist(),
+        np.take_along_axis(top_probs, order, axis=1).tolist(),
+    )
+
+
+def _notify_done(db, job_ids: list[str]) -> None:
+    """Queue a job_done NOTIFY per job; Postgres delivers them on commit."""
+    if not job_ids:
+        return
+    db.execute(
+        text("SELECT pg_notify(:channel, job_id) FROM unnest(CAST(:ids AS text[])) AS job_id"),
+        {"channel": JOB_DONE_CHANNEL, "ids": job_ids},
+    )
+
 
-        img = keras_image.load_img(row["image_path"], target_size=TARGET_SIZE)
-        x = keras_image.img_to_array(img)
-        x = np.expand_dims(x, axis=0)
-        x = preprocess_input(x)
+def _classify_rows(db, rows, top_k_by_id: dict[str, int], start_time: float):
+    """Run one batch through the model and write the results; caller commits."""
+    state = ensure_model(db, logger)
+    labels = state["labels"] or []
 
-        predictions = model.predict(x, verbose=0)
-        probs = np.squeeze(predictions)
+    errors: dict[str, str] = {}
+    loaded = []
+    for row in rows:
+        try:
+            load_image_into(row["image_path"], _BATCH_BUF[len(loaded)])
+        except Exception as exc:
+            errors[str(row["id"])] = str(exc)
+            continue
+        loaded.append(row)
 
-        k = max(1, min(int(top_k), 5, len(probs)))
-        indices = np.argsort(probs)[::-1][:k]
-        top_k_list = []
-        for idx in indices.tolist():
-            label = labels[int(idx)] if int(idx) < len(labels) else str(idx)
-            top_k_list.append({"label": label, "confidence": float(probs[int(idx)])})
+    results = []
+    if loaded:
+        x = _BATCH_BUF[: len(loaded)]
+        subtract_mean(x)
+        probs = predict(state, x)
 
+        k_max = max(1, min(max(top_k_by_id.values()), 5, probs.shape[1]))
+        indices, confidences = _top_k(probs, k_max)
+        for row, row_indices, row_confidences in zip(loaded, indices, confidences):
+            k = max(1, min(top_k_by_id[str(row["id"])], k_max))
+            top_k_list = [
+                {"label": labels[idx] if idx < len(labels) else str(idx), "confidence": conf}
+                for idx, conf in zip(row_indices[:k], row_confidences[:k])
+            ]
+            results.append((row, top_k_list))
+
+    priced_labels = {
+        top_k_list[0]["label"]
+        for row, top_k_list in results
+        if top_k_list and row["weight_kg"] is not None
+    }
+    prices = _fetch_prices(db, priced_labels)
+
+    latency_ms = int((time.time() - start_time) * 1000)
+    updates = []
+    for row, top_k_list in results:
         predicted_label = top_k_list[0]["label"] if top_k_list else None
         confidence = top_k_list[0]["confidence"] if top_k_list else None
 
         price_per_kg = None
         total_price = None
         if predicted_label and row["weight_kg"] is not None:
-            price_row = db.execute(
-                text("SELECT price_per_kg FROM product_prices WHERE label = :label"),
-                {"label": predicted_label},
-            ).mappings().first()
-            price_per_kg = price_row["price_per_kg"] if price_row else DEFAULT_PRICE_PER_KG
+            price_per_kg = prices.get(predicted_label, DEFAULT_PRICE_PER_KG)
             total_price = price_per_kg * row["weight_kg"]
 
-        latency_ms = int((time.time() - start_time) * 1000)
+        updates.append(
+            {
+                "id": str(row["id"]),
+                "predicted_label": predicted_label,
+                "confidence": confidence,
+                # The done constraint needs the hash; compute it here if
+                # hash_image has not landed yet.
+                "image_sha256": row["image_sha256"] or _file_sha256(row["image_path"]),
+                "top_k": top_k_list,
+                "price_per_kg": price_per_kg,
+                "total_price": total_price,
+                "latency_ms": latency_ms,
+                "model_id": state["model_id"],
+                "model_revision": state["model_revision"],
+            }
+        )
+
+    if updates:
         db.execute(
             text(
                 """
                 UPDATE inference_requests
                 SET status = 'done',
+                    image_sha256 = COALESCE(image_sha256, :image_sha256),
                     predicted_label = :predicted_label,
                     confidence = :confidence,
-                    top_k = CAST(:top_k AS jsonb),
+                    top_k = :top_k,
                     price_per_kg = :price_per_kg,
                     total_price = :total_price,
                     latency_ms = :latency_ms,
@@ -87,41 +244,111 @@ def classify(job_id: str, top_k: int = 3) -> None:
                     model_revision = :model_revision
                 WHERE id = :id
                 """
-            ),
-            {
-                "id": job_id,
-                "predicted_label": predicted_label,
-                "confidence": confidence,
-                "top_k": json.dumps(top_k_list),
-                "price_per_kg": price_per_kg,
-                "total_price": total_price,
-                "latency_ms": latency_ms,
-                "model_id": state["model_id"],
-                "model_revision": state["model_revision"],
-            },
+            ).bindparams(bindparam("top_k", type_=JSONB)),
+            updates,
         )
-        db.commit()
+    _mark_errors(db, errors)
+    _notify_done(db, [update["id"] for update in updates] + list(errors))
+    return updates, errors, latency_ms
 
-        logger.info(
-            "job_completed",
-            extra={
-                "job_id": job_id,
-                "status": "done",
-                "predicted_label": predicted_label,
-                "confidence": confidence,
-                "latency_ms": latency_ms,
-                "low_confidence": confidence is not None and confidence < CONFIDENCE_THRESHOLD,
-            },
-        )
-    except Exception as exc:
-        db.rollback()
+
+def _claim_rows(db, job_ids: list[str]):
+    rows = db.execute(
+        text(
+            """
+            SELECT id, image_path, image_sha256, weight_kg
+            FROM inference_requests WHERE id IN :ids
+            """
+        ).bindparams(bindparam("ids", expanding=True)),
+        {"ids": job_ids},
+    ).mappings().all()
+    found = {str(row["id"]) for row in rows}
+    for job_id in job_ids:
+        if job_id not in found:
+            logger.error("job_missing", extra={"job_id": job_id})
+    if rows:
         db.execute(
             text(
-                "UPDATE inference_requests SET status = 'error', error = :error WHERE id = :id"
-            ),
-            {"id": job_id, "error": str(exc)},
+                "UPDATE inference_requests SET status = 'running' WHERE id IN :ids"
+            ).bindparams(bindparam("ids", expanding=True)),
+            {"ids": list(found)},
         )
-        db.commit()
-        logger.error("job_error", extra={"job_id": job_id, "error": str(exc)})
-    finally:
-        db.close()
+    return rows
+
+
+def _classify_jobs(jobs: list[dict[str, Any]]) -> None:
+    start_time = time.time()
+    top_k_by_id = {str(job["job_id"]): int(job.get("top_k", 3)) for job in jobs}
+    job_ids = list(top_k_by_id)
+    try:
+        # Safe to retry after a dropped connection: nothing has run yet.
+        rows = run_in_worker_db(lambda db: _claim_rows(db, job_ids))
+        if not rows:
+            return
+        job_ids = [str(row["id"]) for row in rows]
+
+        db = get_worker_db()
+        with db.begin():
+            updates, errors, latency_ms = _classify_rows(db, rows, top_k_by_id, start_time)
+
+        for update in updates:
+            confidence = update["confidence"]
+            logger.info(
+                "job_completed",
+                extra={
+                    "job_id": update["id"],
+                    "status": "done",
+                    "predicted_label": update["predicted_label"],
+                    "confidence": confidence,
+                    "latency_ms": latency_ms,
+                    "batch_size": len(updates),
+                    "low_confidence": confidence is not None and confidence < CONFIDENCE_THRESHOLD,
+                },
+            )
+        for job_id, error in errors.items():
+            logger.error("job_error", extra={"job_id": job_id, "error": error})
+    except Exception as exc:
+        # db.begin() has already rolled back the failed transaction.
+        db = get_worker_db()
+        with db.begin():
+            _mark_errors(db, {job_id: str(exc) for job_id in job_ids})
+            _notify_done(db, job_ids)
+        for job_id in job_ids:
+            logger.error("job_error", extra={"job_id": job_id, "error": str(exc)})
+
+
+@celery_app.task(name="worker_tasks.hash_image")
+def hash_image(job_id: str, image_path: str) -> None:
+    try:
+        image_sha = _file_sha256(image_path)
+        run_in_worker_db(
+            lambda db: db.execute(
+                text(
+                    """
+                    UPDATE inference_requests SET image_sha256 = :image_sha256
+                    WHERE id = :id AND image_sha256 IS NULL
+                    """
+                ),
+                {"id": job_id, "image_sha256": image_sha},
+            )
+        )
+        logger.info("image_hashed", extra={"job_id": job_id, "image_sha256": image_sha})
+    except Exception as exc:
+        logger.error("image_hash_error", extra={"job_id": job_id, "error": str(exc)})
+
+
+@celery_app.task(name="worker_tasks.classify_batch")
+def classify_batch() -> None:
+    # Every queued job sends one trigger. A trigger can be spent by a drain
+    # that filled up before reaching its job, so whoever leaves jobs behind
+    # sends another trigger for them.
+    jobs, backlog = _drain_pending()
+    if backlog:
+        classify_batch.delay()
+    if jobs:
+        _classify_jobs(jobs)
+
+
+@celery_app.task(name="worker_tasks.classify")
+def classify(job_id: str, top_k: int = 3) -> None:
+    _classify_jobs([{"job_id": job_id, "top_k": top_k}])